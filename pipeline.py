@@ -1,23 +1,45 @@
 #!/usr/bin/env python3
 
+import concurrent.futures
+import contextlib
+import fcntl
+import fnmatch
+import functools
+import importlib
+import io
+import json
+import logging
+import operator
 import os
+import pathlib
+import re
 import shlex
 import subprocess
 import sys
+import threading
+import time
+import traceback
 
 try:
-	from bids import BIDSLayout
-except Exception:
-	BIDSLayout = None
-
-try:
-	from utils import app_name, version, release_date
+	from version import app_name, version, release_date
 except Exception:
 	app_name = 'GGR-recon'
 	version = 'unknown'
 	release_date = ''
 
 ACQ_ORDER = ['sag', 'cor', 'ax']
+ACQ_IDX = {acq: ii for ii, acq in enumerate(ACQ_ORDER)}
+ACQ_COMPLETE_MASK = (1 << len(ACQ_ORDER)) - 1
+DEFAULT_DATA_PATH = '/opt/GGR-recon/data/'
+DEFAULT_TEMP_PATH = '/opt/GGR-recon/temp/'
+DEFAULT_OUT_PATH = '/opt/GGR-recon/recons/'
+PREPROCESS_TEMP_NAMES = ['-t', '--temp_path', '--working_path', '-w']
+OUT_NAMES = ['-o', '--out_path']
+# run_group statuses for groups it did not run (otherwise it returns the exit code).
+GROUP_LOCKED = 'locked'
+GROUP_DONE = 'done'
+# Directory names (fnmatch patterns) never searched for groups; extended by --scan-ignore.
+SCAN_IGNORE_DIRS = ('derivatives', 'sourcedata', 'code', '.git', '.datalad')
 FILTER_KEY_ALIASES = {
 	'sub': 'subject',
 	'ses': 'session',
@@ -25,6 +47,42 @@ FILTER_KEY_ALIASES = {
 	'rec': 'reconstruction',
 }
 GROUP_EXCLUDED_ENTITIES = {'acquisition', 'suffix', 'extension', 'datatype'}
+# entities pybids (and so preprocess.py) compares as integers: run=1 matches run-01
+INT_ENTITIES = {'run'}
+# BIDS entity label (bids2table column) -> pybids entity name (only entities pybids can filter on).
+BIDS_ENTITY_NAMES = {
+	'sub': 'subject',
+	'ses': 'session',
+	'sample': 'sample',
+	'task': 'task',
+	'acq': 'acquisition',
+	'ce': 'ceagent',
+	'trc': 'tracer',
+	'stain': 'staining',
+	'rec': 'reconstruction',
+	'dir': 'direction',
+	'run': 'run',
+	'mod': 'modality',
+	'echo': 'echo',
+	'flip': 'flip',
+	'inv': 'inv',
+	'mt': 'mt',
+	'part': 'part',
+	'proc': 'proc',
+	'space': 'space',
+	'recording': 'recording',
+	'chunk': 'chunk',
+	'datatype': 'datatype',
+	'suffix': 'suffix',
+	'ext': 'extension',
+}
+# Group keys list entities in BIDS filename order, so they never need sorting.
+GROUP_ENTITY_ORDER = tuple(name for name in BIDS_ENTITY_NAMES.values()
+		if name not in GROUP_EXCLUDED_ENTITIES)
+# Only T2w files with one of the ACQ_ORDER acquisitions match; the acq group gives the slot.
+T2W_FILENAME_RE = re.compile(r'^sub-[a-zA-Z0-9+]+(?:_[a-zA-Z]+-[a-zA-Z0-9+]+)*?'
+		r'_acq-(?P<acq>%s)(?:_[a-zA-Z]+-[a-zA-Z0-9+]+)*_T2w(?P<ext>\.nii(?:\.gz)?)$'
+		% '|'.join(ACQ_ORDER))
 
 def print_help():
 	print('usage: pipeline.py [PREPROCESS_ARGS ...] [-- RECON_ARGS ...]')
@@ -42,6 +100,18 @@ def print_help():
 	print('  - If "--" is omitted, no extra args are passed to recon.py (defaults are used).')
 	print('  - If no explicit -f/--filenames is provided, pipeline runs all complete BIDS groups matching filters.')
 	print('  - All original preprocess.py and recon.py arguments are supported via passthrough.')
+	print('  - --jobs N (before "--") runs up to N groups concurrently, each with its own')
+	print('    temp_path subfolder. Groups locked by another pipeline.py run are skipped and')
+	print('    listed at the end.')
+	print('  - Group discovery only looks at sub-*/[ses-*/]anat. --scan-ignore PATTERN (repeatable,')
+	print('    before "--") skips files whose sub-*, ses-* or anat folder name matches PATTERN')
+	print('    (shell-style wildcards), in addition to derivatives, sourcedata, code, .git and .datalad.')
+	print('  - Groups that already completed (out_path/.group-<key>.done) are skipped;')
+	print('    failed groups are recorded in out_path/failures.jsonl.')
+	print('  - --dry-run (before "--") lists the discovered groups, their filters and input files,')
+	print('    then exits without running preprocess.py or recon.py.')
+	print('  - --bids2table (before "--") discovers groups with bids2table instead of walking')
+	print('    sub-*/[ses-*/]anat; it indexes the whole dataset, so it is slower on most trees.')
 
 
 def split_passthrough_args(argv):
@@ -50,61 +120,64 @@ def split_passthrough_args(argv):
 		return argv[:sep], argv[sep + 1:]
 	return argv, []
 
-def parse_preprocess_path(args):
-	path = '/opt/GGR-recon/data/'
+@functools.lru_cache(maxsize=16)
+def index_args_tuple(args):
+	# Single pass: option name -> [(position, value), ...]; value is True for bare flags.
+	index = {}
 	ii = 0
 	while ii < len(args):
 		token = args[ii]
-		if token in ('-p', '--path') and ii + 1 < len(args):
-			path = args[ii + 1]
-			ii += 2
-			continue
-		if token.startswith('--path='):
-			path = token.split('=', 1)[1]
+		pos = ii
+		if token.startswith('-'):
+			if '=' in token:
+				name, value = token.split('=', 1)
+			elif ii + 1 < len(args) and not args[ii + 1].startswith('-'):
+				name, value = token, args[ii + 1]
+				ii += 1
+			else:
+				name, value = token, True
+			index.setdefault(name, []).append((pos, value))
 		ii += 1
-	return path
+	return index
 
-def has_filenames_arg(args):
-	return '-f' in args or '--filenames' in args
-
-def has_option(args, names):
-	for ii, token in enumerate(args):
-		if token in names:
-			return True
-		for name in names:
-			if token.startswith(name + '='):
-				return True
-	return False
+def index_args(args):
+	return index_args_tuple(tuple(args))
 
-def get_last_option_value(args, names):
-	value = None
+def pop_option_values(args, names):
+	values = []
+	remaining = []
 	ii = 0
 	while ii < len(args):
 		token = args[ii]
 		if token in names and ii + 1 < len(args):
-			value = args[ii + 1]
+			values.append(args[ii + 1])
 			ii += 2
 			continue
-		for name in names:
-			if token.startswith(name + '='):
-				value = token.split('=', 1)[1]
-				break
+		if any(token.startswith(name + '=') for name in names):
+			values.append(token.split('=', 1)[1])
+		else:
+			remaining.append(token)
 		ii += 1
-	return value
+	return values, remaining
 
-def extract_bids_filters(args):
-	raw_filters = []
-	ii = 0
-	while ii < len(args):
-		token = args[ii]
-		if token == '--bids-filter' and ii + 1 < len(args):
-			raw_filters.append(args[ii + 1])
-			ii += 2
-			continue
-		if token.startswith('--bids-filter='):
-			raw_filters.append(token.split('=', 1)[1])
-		ii += 1
-	return raw_filters
+def has_filenames_index(index):
+	return '-f' in index or '--filenames' in index
+
+def has_option(args, names):
+	index = index_args(args)
+	return any(name in index for name in names)
+
+def get_last_option_value(args, names):
+	return last_indexed_value(index_args(args), names)
+
+def last_indexed_value(index, names):
+	matches = [entry for name in names for entry in index.get(name, []) if entry[1] is not True]
+	if len(matches) == 0:
+		return None
+	return max(matches)[1]
+
+def indexed_bids_filters(index):
+	return [value for _, value in index.get('--bids-filter', []) if value is not True]
 
 def parse_filter_key_value(raw):
 	if '=' not in raw:
@@ -119,115 +192,514 @@ def parse_filter_key_value(raw):
 	return key, value
 
 def group_key_from_entities(entities):
-	items = []
-	for key, value in entities.items():
-		if value is None or key in GROUP_EXCLUDED_ENTITIES:
-			continue
-		items.append((key, str(value)))
-	return tuple(sorted(items))
-
-def better_path(path_a, path_b):
-	if path_a is None:
-		return path_b
-	depth_a = path_a.count(os.sep)
-	depth_b = path_b.count(os.sep)
-	if depth_b < depth_a:
-		return path_b
-	if depth_a < depth_b:
-		return path_a
-	return min(path_a, path_b)
+	return tuple((key, str(entities[key])) for key in GROUP_ENTITY_ORDER
+			if entities.get(key) is not None)
 
 def format_group_key(group_key):
-	order = {'subject': 0, 'session': 1, 'reconstruction': 2}
-	pairs = sorted(group_key, key=lambda kv: (order.get(kv[0], 99), kv[0], kv[1]))
-	return '_'.join('%s-%s' % (key, value) for key, value in pairs)
+	return '_'.join('%s-%s' % (key, value) for key, value in group_key)
+
+@functools.lru_cache(maxsize=4)
+def load_bids_table(root):
+	from bids2table import bids2table
+	# bids2table warns once per file outside a dataset_description.json dataset.
+	logging.getLogger('bids2table').setLevel(logging.ERROR)
+	table = bids2table(root, with_meta=False, persistent=False, workers=os.cpu_count())
+	columns = [col for col in BIDS_ENTITY_NAMES if col in table.ent.columns]
+	df = table.ent[columns].copy()
+	names = table.finfo['file_path'].astype('string').map(os.path.basename)
+	for col in df.columns:
+		# Numeric entities (run, echo, ...) come back as float, which drops zero padding;
+		# take the label from the filename so keys match the scandir path (run-01).
+		if df[col].dtype.kind == 'f':
+			df[col] = names.str.extract(r'(?:^|_)%s-([a-zA-Z0-9+]+)' % col)[0]
+		df[col] = df[col].astype('string')
+	df = df.rename(columns=BIDS_ENTITY_NAMES)
+	df['path'] = table.finfo['file_path'].astype('string')
+	return df
+
+def discover_groups_bids2table(root, filters, scan_ignore):
+	try:
+		df = load_bids_table(root)
+	except ImportError:
+		raise
+	except Exception:
+		return []
+	if len(df) == 0:
+		return []
 
-def discover_group_filter_sets(preprocess_args):
-	if BIDSLayout is None:
-		return None
+	# bids2table reports resolved paths, so relativize against the resolved root
+	real_root = os.path.realpath(root)
+	rel_path = df['path'].map(lambda path: os.path.relpath(path, real_root))
+	mask = ((df['suffix'] == 'T2w')
+			& df['acquisition'].isin(ACQ_ORDER)
+			& df['extension'].isin(['.nii', '.nii.gz'])
+			& (df['datatype'] == 'anat')
+			& df['subject'].notna())
+	for key, value in filters.items():
+		if key not in df.columns:
+			return []
+		values = value if isinstance(value, list) else [value]
+		if key in INT_ENTITIES:
+			mask &= df[key].fillna('').map(
+					lambda label: any(entity_matches(key, label, v) for v in values)).astype(bool)
+		else:
+			mask &= df[key].isin(values)
+	mask = mask.fillna(False)
+	# bids2table indexes the whole tree; keep what the scandir walk would visit.
+	scanned = rel_path[mask].map(lambda rel: is_scanned_anat_path(rel, scan_ignore))
+	filtered = df[mask][scanned.astype(bool)]
+	if len(filtered) == 0:
+		return []
 
-	root = parse_preprocess_path(preprocess_args)
+	group_cols = [col for col in filtered.columns
+			if col not in GROUP_EXCLUDED_ENTITIES and col != 'path'
+			and filtered[col].notna().any()]
+	# Shallowest path wins per acquisition; ties go to the lexicographically smallest.
+	# Missing entities become '' so pivot_table keeps those rows in the index.
+	filtered = filtered.assign(depth=filtered['path'].str.count(os.sep))
+	filtered = filtered.sort_values(['depth', 'path'])
+	filtered[group_cols] = filtered[group_cols].astype(object).fillna('')
+	winners = filtered.drop_duplicates(subset=group_cols + ['acquisition'], keep='first')
+	piv = winners.pivot_table(index=group_cols, columns='acquisition', values='path', aggfunc='first')
+	complete = piv.reindex(columns=list(ACQ_ORDER)).dropna()
+
+	groups = []
+	for keys, paths in zip(complete.index, complete.itertuples(index=False)):
+		if not isinstance(keys, tuple):
+			keys = (keys,)
+		group_key = tuple((key, str(value)) for key, value in zip(group_cols, keys) if value != '')
+		groups.append((group_key, dict(zip(ACQ_ORDER, paths))))
+	return groups
+
+def entities_from_filename(name, extension):
+	entities = {'datatype': 'anat', 'suffix': 'T2w', 'extension': extension}
+	for token in name.split('_')[:-1]:
+		label, value = token.split('-', 1)
+		entity = BIDS_ENTITY_NAMES.get(label)
+		if entity is not None:
+			entities[entity] = value
+	return entities
+
+def is_scan_ignored(name, scan_ignore):
+	return any(fnmatch.fnmatch(name, pattern) for pattern in scan_ignore)
+
+def is_scanned_anat_path(rel_path, scan_ignore):
+	# Both discovery backends only take files at sub-*/[ses-*/]anat/<file>, and
+	# --scan-ignore patterns are matched against each of those folder names.
+	dirs = rel_path.split(os.sep)[:-1]
+	if len(dirs) not in (2, 3) or not dirs[0].startswith('sub-') or dirs[-1] != 'anat':
+		return False
+	if len(dirs) == 3 and not dirs[1].startswith('ses-'):
+		return False
+	return not any(is_scan_ignored(part, scan_ignore) for part in dirs)
+
+def list_anat_dirs(root, scan_ignore):
+	anat_dirs = []
+	if is_scan_ignored('anat', scan_ignore):
+		return anat_dirs
+	with os.scandir(root) as subjects:
+		for sub_entry in subjects:
+			if not sub_entry.name.startswith('sub-') or is_scan_ignored(sub_entry.name, scan_ignore):
+				continue
+			if not sub_entry.is_dir():
+				continue
+			with os.scandir(sub_entry.path) as entries:
+				for entry in entries:
+					if entry.name == 'anat':
+						anat_dirs.append(entry.path)
+					elif entry.name.startswith('ses-') and not is_scan_ignored(entry.name, scan_ignore):
+						anat_dirs.append(os.path.join(entry.path, 'anat'))
+	return anat_dirs
+
+@functools.lru_cache(maxsize=4)
+def load_t2w_candidates(root, scan_ignore):
+	# Superset shared by all --bids-filter variations; user filters are applied in memory.
+	# Only sub-*/[ses-*/]anat is visited, and entities come from filenames without stat calls.
+	candidates = []
+	for anat_dir in list_anat_dirs(root, scan_ignore):
+		try:
+			entries = list(os.scandir(anat_dir))
+		except (FileNotFoundError, NotADirectoryError):
+			continue
+		for entry in entries:
+			match = T2W_FILENAME_RE.match(entry.name)
+			if match is None or not entry.is_file():
+				continue
+			candidates.append((entities_from_filename(entry.name, match.group('ext')),
+					ACQ_IDX[match.group('acq')], entry.path))
+	return tuple(candidates)
+
+def entity_matches(key, entity_value, wanted):
+	if entity_value is None:
+		return False
+	if key in INT_ENTITIES and str(entity_value).isdigit() and wanted.isdigit():
+		return int(entity_value) == int(wanted)
+	return str(entity_value) == wanted
+
+def entities_match_filters(entities, filters):
+	for key, value in filters.items():
+		values = value if isinstance(value, list) else [value]
+		if not any(entity_matches(key, entities.get(key), v) for v in values):
+			return False
+	return True
+
+def discover_groups_walk(root, filters, scan_ignore):
 	try:
-		layout = BIDSLayout(root, validate=False)
-	except Exception:
+		candidates = load_t2w_candidates(root, tuple(scan_ignore))
+	except OSError:
 		return []
 
-	query = {
-		'suffix': 'T2w',
-		'acquisition': ACQ_ORDER,
-		'extension': ['.nii', '.nii.gz'],
-		'datatype': 'anat',
-		'scope': 'raw',
-	}
-	for raw_filter in extract_bids_filters(preprocess_args):
+	rows = []
+	for entities, slot, path in candidates:
+		if not entities_match_filters(entities, filters):
+			continue
+		rows.append((group_key_from_entities(entities), slot, path.count(os.sep), path))
+
+	# Sorted by (group, acq, depth, path), the first row per (group, acq) is the
+	# shallowest path, ties broken lexicographically.
+	# groups: group_key -> [path_sag, path_cor, path_ax, acquisition bitmask]
+	groups = {}
+	for group_key, slot, _, path in sorted(rows):
+		entry = groups.setdefault(group_key, [None, None, None, 0])
+		if entry[slot] is None:
+			entry[slot] = path
+			entry[3] |= 1 << slot
+
+	return [(group_key, dict(zip(ACQ_ORDER, entry[:3])))
+			for group_key, entry in groups.items() if entry[3] == ACQ_COMPLETE_MASK]
+
+def discover_group_filter_sets(preprocess_args, scan_ignore=SCAN_IGNORE_DIRS, index=None,
+		use_bids2table=False):
+	if index is None:
+		index = index_args(preprocess_args)
+	root = last_indexed_value(index, ['-p', '--path']) or DEFAULT_DATA_PATH
+	filters = {}
+	for raw_filter in indexed_bids_filters(index):
 		key, value = parse_filter_key_value(raw_filter)
 		if key is not None:
-			query[key] = value
+			filters[key] = value
+
+	# The scandir walk only visits sub-*/[ses-*/]anat; bids2table indexes the whole tree
+	# (derivatives included), so it is opt-in and falls back to the walk when missing.
+	groups = None
+	if use_bids2table:
+		try:
+			groups = discover_groups_bids2table(root, filters, scan_ignore)
+		except ImportError:
+			print('[pipeline] bids2table is not installed; using the directory walk.')
+	if groups is None:
+		groups = discover_groups_walk(root, filters, scan_ignore)
+
+	# Format each label once; it is reused for sorting, progress output and marker paths.
+	complete = []
+	for group_key, acq_map in groups:
+		filter_args = []
+		for key, value in group_key:
+			filter_args += ['--bids-filter', '%s=%s' % (key, value)]
+		complete.append((format_group_key(group_key), group_key, filter_args, acq_map))
 
+	complete.sort(key=operator.itemgetter(0))
+	return complete
+
+def print_groups(discovered):
+	print('[pipeline] discovered %d complete BIDS groups.' % len(discovered))
+	for label, _, filter_args, acq_map in discovered:
+		print(label)
+		print('  ' + shlex.join(filter_args))
+		for acq in ACQ_ORDER:
+			print('  %s: %s' % (acq, acq_map[acq]))
+
+def group_state_path(out_path, label, kind):
+	return os.path.join(out_path, '.group-%s.%s' % (label, kind))
+
+def run_group(label, preprocess_args, recon_args, out_path, prefix_output=False):
+	# The lock keeps concurrent pipeline.py invocations from reconstructing the same group.
+	# Returns GROUP_LOCKED when another run holds it.
+	os.makedirs(out_path, exist_ok=True)
+	lock_path = group_state_path(out_path, label, 'lock')
+	fd = acquire_group_lock(lock_path)
+	if fd is None:
+		print('[pipeline] %s is locked by another run (%s); skipping.' % (label, lock_path))
+		return label, GROUP_LOCKED
 	try:
-		bids_files = layout.get(return_type='object', **query)
-	except Exception:
-		return []
-	groups = {}
-	for bids_file in bids_files:
-		entities = bids_file.get_entities()
-		acq = str(entities.get('acquisition', ''))
-		if acq not in ACQ_ORDER:
+		# Another run may have finished the group between run_groups' check and the lock.
+		if os.path.exists(group_state_path(out_path, label, 'done')):
+			print('[pipeline] %s was completed by another run; skipping.' % label)
+			return label, GROUP_DONE
+		with prefixed_output('[%s] ' % label) if prefix_output else contextlib.nullcontext():
+			rc, failure = run_single(preprocess_args, recon_args)
+		if rc == 0:
+			pathlib.Path(group_state_path(out_path, label, 'done')).touch()
+		else:
+			record_failure(out_path, label, failure)
+		return label, rc
+	finally:
+		os.remove(lock_path)
+		os.close(fd)
+
+def record_failure(out_path, label, failure):
+	failure['group'] = label
+	failure['time'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+	with open(os.path.join(out_path, 'failures.jsonl'), 'a') as f:
+		f.write(json.dumps(failure) + '\n')
+
+def record_crashed_groups(out_path, group_args, error):
+	# A worker killed mid-group (native crash, OOM kill) leaves its lock file behind;
+	# groups it never started have none. Returns the labels recorded as failed.
+	crashed = []
+	for label, args in group_args:
+		lock_path = group_state_path(out_path, label, 'lock')
+		if not os.path.exists(lock_path):
 			continue
-		if entities.get('subject') is None:
+		fd = acquire_group_lock(lock_path)
+		if fd is None:
 			continue
+		os.remove(lock_path)
+		os.close(fd)
+		print('[pipeline] %s: worker process died (%s)' % (label, error))
+		record_failure(out_path, label, {'script': None, 'returncode': None,
+				'args': args, 'stderr': '', 'error': str(error) or type(error).__name__})
+		crashed.append(label)
+	return crashed
+
+def acquire_group_lock(lock_path):
+	# flock is released by the kernel when the holder dies, so a killed run
+	# (e.g. OOM during recon) leaves no stale lock behind.
+	while True:
+		fd = os.open(lock_path, os.O_CREAT | os.O_WRONLY)
+		try:
+			fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except BlockingIOError:
+			os.close(fd)
+			return None
+		# The holder unlinks the file before releasing it; retry if we locked a removed file.
+		try:
+			same_file = os.path.samestat(os.fstat(fd), os.stat(lock_path))
+		except FileNotFoundError:
+			same_file = False
+		if same_file:
+			os.ftruncate(fd, 0)
+			os.write(fd, str(os.getpid()).encode())
+			return fd
+		os.close(fd)
+
+def report_locked(locked):
+	if len(locked) > 0:
+		print('[pipeline] %d group(s) not run because another pipeline.py run holds their lock: %s'
+				% (len(locked), ', '.join(locked)))
+
+def run_groups(discovered, preprocess_args, recon_args, jobs):
+	out_path = get_last_option_value(preprocess_args, OUT_NAMES) or DEFAULT_OUT_PATH
+	temp_path = get_last_option_value(preprocess_args, PREPROCESS_TEMP_NAMES) or DEFAULT_TEMP_PATH
+
+	pending = []
+	for group in discovered:
+		if os.path.exists(group_state_path(out_path, group[0], 'done')):
+			print('[pipeline] %s already completed; skipping.' % group[0])
+			continue
+		pending.append(group)
+	if len(pending) < len(discovered):
+		print('[pipeline] %d of %d groups pending.' % (len(pending), len(discovered)))
+	discovered = pending
+	if len(discovered) == 0:
+		return 0
 
-		group_key = group_key_from_entities(entities)
-		if group_key not in groups:
-			groups[group_key] = {'acq_map': {}}
-		current = groups[group_key]['acq_map'].get(acq)
-		groups[group_key]['acq_map'][acq] = better_path(current, bids_file.path)
-
-	complete = []
-	for group_key, group in groups.items():
-		if all(acq in group['acq_map'] for acq in ACQ_ORDER):
-			filter_args = []
-			for key, value in group_key:
-				filter_args += ['--bids-filter', '%s=%s' % (key, value)]
-			complete.append((group_key, filter_args))
-
-	complete.sort(key=lambda item: format_group_key(item[0]))
-	return complete
+	# Groups run in worker processes even with --jobs 1, so a native crash or OOM kill
+	# in preprocess/recon ends up in failures.jsonl instead of taking pipeline.py down.
+	locked = []
+	unfinished = None
+	with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+		if jobs == 1:
+			for idx, (label, _, group_filter_args, _) in enumerate(discovered, start=1):
+				print('[pipeline] group %d/%d: %s' % (idx, len(discovered), label))
+				group_args = preprocess_args + group_filter_args
+				try:
+					_, rc = executor.submit(run_group, label, group_args,
+							recon_args, out_path).result()
+				except concurrent.futures.process.BrokenProcessPool as exc:
+					unfinished = [(later_label, preprocess_args + later_filter_args)
+							for later_label, _, later_filter_args, _ in discovered[idx - 1:]]
+					error = exc
+					break
+				if rc == GROUP_LOCKED:
+					locked.append(label)
+				elif rc != GROUP_DONE and rc != 0:
+					return rc
+		else:
+			print('[pipeline] running up to %d groups concurrently.' % jobs)
+			futures = {}
+			for label, _, group_filter_args, _ in discovered:
+				# preprocess.py/recon.py use fixed filenames in temp_path, so each group needs its own.
+				# Appended last so it also overrides a -t/--temp_path given to recon.py after "--".
+				group_temp_path = os.path.join(temp_path, label)
+				group_args = preprocess_args + group_filter_args + ['--temp_path', group_temp_path]
+				group_recon_args = recon_args + ['--temp_path', group_temp_path]
+				future = executor.submit(run_group, label, group_args,
+						group_recon_args, out_path, prefix_output=True)
+				futures[future] = (label, group_args)
+
+			for idx, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+				try:
+					label, rc = future.result()
+				except concurrent.futures.process.BrokenProcessPool as exc:
+					unfinished = [futures[f] for f in futures
+							if not f.done() or f.exception() is not None]
+					error = exc
+					break
+				if rc == GROUP_LOCKED:
+					locked.append(label)
+					continue
+				print('[pipeline] group %d/%d finished: %s' % (idx, len(discovered), label))
+				if rc != GROUP_DONE and rc != 0:
+					executor.shutdown(wait=True, cancel_futures=True)
+					return rc
+
+	if unfinished is not None:
+		# Only checked once the pool is shut down: the surviving workers are gone by then.
+		crashed = record_crashed_groups(out_path, unfinished, error)
+		print('[pipeline] a worker process died; %d group(s) failed (%s), %d not run.'
+				% (len(crashed), ', '.join(crashed), len(unfinished) - len(crashed)))
+		return 1
+	report_locked(locked)
+	return 0
 
 def run_single(preprocess_args, recon_args):
 	final_recon_args = list(recon_args)
-	preprocess_temp_names = ['-t', '--temp_path', '--working_path', '-w']
 	recon_temp_names = ['-t', '--temp_path', '--working_path']
-	out_names = ['-o', '--out_path']
 
 	if not has_option(final_recon_args, recon_temp_names):
-		temp_value = get_last_option_value(preprocess_args, preprocess_temp_names)
+		temp_value = get_last_option_value(preprocess_args, PREPROCESS_TEMP_NAMES)
 		if temp_value is not None:
 			final_recon_args = ['--temp_path', temp_value] + final_recon_args
 
-	if not has_option(final_recon_args, out_names):
-		out_value = get_last_option_value(preprocess_args, out_names)
+	if not has_option(final_recon_args, OUT_NAMES):
+		out_value = get_last_option_value(preprocess_args, OUT_NAMES)
 		if out_value is not None:
 			final_recon_args = ['--out_path', out_value] + final_recon_args
 
-	rc = run_script('preprocess.py', preprocess_args)
-	if rc != 0:
-		print('[pipeline] preprocess.py failed with exit code %d' % rc)
-		return rc
-
-	rc = run_script('recon.py', final_recon_args)
-	if rc != 0:
-		print('[pipeline] recon.py failed with exit code %d' % rc)
-		return rc
-	return 0
+	for script_name, script_args in [('preprocess.py', preprocess_args),
+			('recon.py', final_recon_args)]:
+		rc, stderr = run_script(script_name, script_args)
+		if rc != 0:
+			print('[pipeline] %s failed with exit code %d' % (script_name, rc))
+			return rc, {'script': script_name, 'returncode': rc,
+					'args': script_args, 'stderr': stderr}
+	return 0, None
+
+class PrefixedStream:
+	# Emits whole lines only, each with a prefix, so concurrent groups do not
+	# interleave mid-line. Reports a non-tty so rich skips live redraws.
+	def __init__(self, stream, prefix):
+		self.stream = stream
+		self.prefix = prefix
+		self.pending = ''
+		self.lock = threading.Lock()
+
+	def write(self, text):
+		with self.lock:
+			lines = (self.pending + text).split('\n')
+			self.pending = lines.pop()
+			if len(lines) > 0:
+				self.stream.write(''.join(self.prefix + line + '\n' for line in lines))
+				self.stream.flush()
+		return len(text)
+
+	def flush(self):
+		self.stream.flush()
+
+	def close(self):
+		with self.lock:
+			if self.pending != '':
+				self.stream.write(self.prefix + self.pending + '\n')
+				self.pending = ''
+		self.stream.flush()
+
+	def isatty(self):
+		return False
+
+	def __getattr__(self, name):
+		return getattr(self.stream, name)
+
+@contextlib.contextmanager
+def prefixed_output(prefix):
+	stdout = PrefixedStream(sys.stdout, prefix)
+	stderr = PrefixedStream(sys.stderr, prefix)
+	try:
+		with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+			yield
+	finally:
+		stdout.close()
+		stderr.close()
+
+def pump_lines(pipe, stream):
+	for line in pipe:
+		stream.write(line)
+	pipe.close()
+
+class TeeStream:
+	# Passes writes through to the wrapped stream while keeping a copy.
+	def __init__(self, stream):
+		self.stream = stream
+		self.captured = io.StringIO()
+
+	def write(self, text):
+		self.captured.write(text)
+		return self.stream.write(text)
+
+	def flush(self):
+		self.stream.flush()
+
+	def __getattr__(self, name):
+		return getattr(self.stream, name)
+
+def exit_code(code):
+	if code is None:
+		return 0
+	if isinstance(code, int):
+		return code
+	print(code, file=sys.stderr)
+	return 1
 
 def run_script(script_name, script_args):
+	# Run the script's main() in this interpreter so numpy/SimpleITK/pybids are
+	# imported once per process rather than once per group.
+	try:
+		module = importlib.import_module(os.path.splitext(script_name)[0])
+	except Exception:
+		module = None
+	if module is not None and hasattr(module, 'main'):
+		print('[pipeline] running:', ' '.join(shlex.quote(token) for token in [script_name] + script_args))
+		sys.stdout.flush()
+		stderr = TeeStream(sys.stderr)
+		with contextlib.redirect_stderr(stderr):
+			try:
+				rc = exit_code(module.main(list(script_args)))
+			except SystemExit as exc:
+				rc = exit_code(exc.code)
+			except Exception:
+				traceback.print_exc()
+				rc = 1
+		return rc, stderr.captured.getvalue()
+
 	script_path = os.path.join(os.path.dirname(__file__), script_name)
 	cmd = [sys.executable, script_path] + script_args
 	print('[pipeline] running:', ' '.join(shlex.quote(token) for token in cmd))
-	result = subprocess.run(cmd)
-	return result.returncode
-
+	sys.stdout.flush()
+	# Output is streamed line by line as the child runs. stdout stays attached to the
+	# terminal unless it has been redirected (e.g. prefixed for concurrent groups).
+	pipe_stdout = sys.stdout is not sys.__stdout__
+	proc = subprocess.Popen(cmd, stdout=subprocess.PIPE if pipe_stdout else None,
+			stderr=subprocess.PIPE, text=True, bufsize=1)
+	stderr = TeeStream(sys.stderr)
+	pumps = [threading.Thread(target=pump_lines, args=(proc.stderr, stderr))]
+	if pipe_stdout:
+		pumps.append(threading.Thread(target=pump_lines, args=(proc.stdout, sys.stdout)))
+	for pump in pumps:
+		pump.start()
+	rc = proc.wait()
+	for pump in pumps:
+		pump.join()
+	return rc, stderr.captured.getvalue()
 
 def main():
 	argv = sys.argv[1:]
@@ -240,30 +712,41 @@ def main():
 		return 0
 
 	preprocess_args, recon_args = split_passthrough_args(argv)
-	raw_filters = extract_bids_filters(preprocess_args)
+	jobs_values, preprocess_args = pop_option_values(preprocess_args, ['--jobs'])
+	try:
+		jobs = int(jobs_values[-1]) if len(jobs_values) > 0 else 1
+	except ValueError:
+		jobs = 0
+	if jobs < 1:
+		print('[pipeline] --jobs expects a positive integer, got "%s"' % jobs_values[-1])
+		return 1
+	scan_ignore, preprocess_args = pop_option_values(preprocess_args, ['--scan-ignore'])
+	scan_ignore = SCAN_IGNORE_DIRS + tuple(scan_ignore)
+	dry_run = '--dry-run' in preprocess_args
+	use_bids2table = '--bids2table' in preprocess_args
+	preprocess_args = [arg for arg in preprocess_args if arg not in ('--dry-run', '--bids2table')]
 	# Expand into all matching groups unless explicit filenames are provided.
 	# This includes cases with filters (e.g., subject/session without rec).
-	should_expand_groups = not has_filenames_arg(preprocess_args)
+	index = index_args(preprocess_args)
+	should_expand_groups = not has_filenames_index(index)
 
 	if should_expand_groups:
-		discovered = discover_group_filter_sets(preprocess_args)
-		if discovered is None:
-			print('[pipeline] pybids is unavailable; running a single preprocess/recon pair.')
-			return run_single(preprocess_args, recon_args)
+		discovered = discover_group_filter_sets(preprocess_args, scan_ignore, index,
+				use_bids2table)
+		if dry_run:
+			print_groups(discovered)
+			return 0
 		if len(discovered) == 0:
 			print('[pipeline] no complete BIDS groups found with no filters; running single pass.')
-			return run_single(preprocess_args, recon_args)
+			return run_single(preprocess_args, recon_args)[0]
 
 		print('[pipeline] discovered %d complete BIDS groups.' % len(discovered))
-		for idx, (group_key, group_filter_args) in enumerate(discovered, start=1):
-			print('[pipeline] group %d/%d: %s' % (
-					idx, len(discovered), format_group_key(group_key)))
-			rc = run_single(preprocess_args + group_filter_args, recon_args)
-			if rc != 0:
-				return rc
-		return 0
+		return run_groups(discovered, preprocess_args, recon_args, jobs)
 
-	return run_single(preprocess_args, recon_args)
+	if dry_run:
+		print('[pipeline] explicit -f/--filenames given; nothing to discover.')
+		return 0
+	return run_single(preprocess_args, recon_args)[0]
 
 
 if __name__ == '__main__':
@@ -1,30 +1,18 @@
 #!/usr/bin/env python3
 
-import numpy as np
-import SimpleITK as sitk
-from scipy.io import loadmat, savemat
-from scipy import signal
 import json
 import os
 import sys
 import time
 import argparse
 import pathlib
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 
-try:
-	from bids import BIDSLayout
-	from bids.layout import parse_file_entities
-except ImportError:
-	BIDSLayout = None
-	parse_file_entities = None
-
-from utils import *
-
-from rich.console import Console
-from rich import box
-from rich.table import Table
-from rich.panel import Panel
-from rich.progress import track
+# numpy, SimpleITK, scipy, rich and pybids are imported where they are used,
+# so that -h/--version do not pay for them
+from version import app_name, version, release_date
 
 ACQ_ORDER = ['sag', 'cor', 'ax']
 FILTER_KEY_ALIASES = {
@@ -53,6 +41,31 @@ KNOWN_DATATYPES = {
 	'anat', 'func', 'dwi', 'fmap', 'perf', 'pet', 'meg', 'eeg', 'ieeg', 'micr'
 }
 GROUP_EXCLUDED_ENTITIES = {'acquisition', 'suffix', 'extension'}
+# entities pybids stores as integers, so run=1 matches run-01
+INT_ENTITIES = {'run'}
+
+@dataclass
+class ImgEntry:
+	fn: str
+	ext: str
+	input: str
+	working_x: str
+	working_reg_x: str
+	tfm: str
+	filter: str
+
+def make_img_entry(filename, working_path):
+	fpname = pathlib.PurePosixPath(filename)
+	base, _, rest = fpname.name.partition('.')
+	p = str(fpname.parent)
+	if not p.endswith('/'):
+		p += '/'
+	ext = '.' + rest
+	return ImgEntry(fn=base, ext=ext, input=p + base + ext,
+			working_x=working_path + base + '_x' + ext,
+			working_reg_x=working_path + 'reg_' + base + '_x' + ext,
+			tfm=working_path + 'tfm2_' + base + '.tfm',
+			filter=working_path + 'h_' + base + '.npy')
 
 def ensure_dir(path):
 	if path.endswith('/'):
@@ -69,14 +82,12 @@ def normalize_bids_entity(name, value):
 	return prefix + value
 
 def entity_to_token(key, value):
-	label = ENTITY_NAME_TO_LABEL.get(key, key)
-	return '%s-%s' % (label, value)
+	return f'{ENTITY_NAME_TO_LABEL.get(key, key)}-{value}'
 
 def infer_datatype_from_path(filename):
-	parent = pathlib.Path(filename).parent.name
-	if parent in KNOWN_DATATYPES:
-		return parent
-	for part in reversed(pathlib.Path(filename).parts):
+	# the parent folder is checked first, then the remaining path components
+	parts = filename.replace('\\', '/').split('/')
+	for part in reversed(parts[:-1]):
 		if part in KNOWN_DATATYPES:
 			return part
 	return 'anat'
@@ -99,12 +110,9 @@ def parse_bids_filters(raw_filters):
 	return parsed
 
 def group_key_from_entities(entities):
-	items = []
-	for key, value in entities.items():
-		if value is None or key in GROUP_EXCLUDED_ENTITIES:
-			continue
-		items.append((key, str(value)))
-	return tuple(sorted(items))
+	# only used as a dict key, so no ordering is needed
+	return frozenset((key, str(value)) for key, value in entities.items()
+			if value is not None and key not in GROUP_EXCLUDED_ENTITIES)
 
 def format_group_label(group_entities):
 	parts = []
@@ -135,15 +143,18 @@ def collect_candidate_groups(file_records):
 		if acq not in ACQ_ORDER:
 			continue
 
+		# no early exit once a group is complete: later records may still be a
+		# duplicate acquisition or a second complete group, both of which are errors
 		group_key = group_key_from_entities(entities)
-		if group_key not in groups:
-			groups[group_key] = {'entities': dict(entities), 'acq_map': {}}
+		group = groups.get(group_key)
+		if group is None:
+			group = groups[group_key] = {'entities': dict(entities), 'acq_map': {}}
 
-		if acq in groups[group_key]['acq_map']:
-			prev = groups[group_key]['acq_map'][acq]
+		acq_map = group['acq_map']
+		if acq in acq_map:
 			raise ValueError('duplicate "%s" acquisition found for %s: %s and %s' % (
-					acq, format_group_label(groups[group_key]['entities']), prev, record['path']))
-		groups[group_key]['acq_map'][acq] = record['path']
+					acq, format_group_label(group['entities']), acq_map[acq], record['path']))
+		acq_map[acq] = record['path']
 
 	return groups
 
@@ -211,15 +222,15 @@ def build_bids_output_name(reference_file, source_reconstruction=None):
 	out_tokens.append('T2w')
 	return '_'.join(out_tokens) + ext
 
-def relativize_paths(paths, root_path):
+def relativize_paths(abs_paths, root_path):
 	if root_path is None:
-		return [os.path.abspath(path) for path in paths]
+		return list(abs_paths)
 
+	root_path = os.path.abspath(root_path)
 	output = []
-	for path in paths:
-		abspath = os.path.abspath(path)
+	for abspath in abs_paths:
 		try:
-			relpath = os.path.relpath(abspath, os.path.abspath(root_path))
+			relpath = os.path.relpath(abspath, root_path)
 			if not relpath.startswith('..'):
 				output.append(relpath.replace(os.sep, '/'))
 			else:
@@ -228,7 +239,9 @@ def relativize_paths(paths, root_path):
 			output.append(abspath)
 	return output
 
-def build_bids_info(group, flist, root_path=None):
+def build_bids_info(group, flist, root_path=None, abs_flist=None):
+	if abs_flist is None:
+		abs_flist = [os.path.abspath(path) for path in flist]
 	entities = group['entities']
 	sub = normalize_bids_entity('sub', entities.get('subject'))
 	ses = normalize_bids_entity('ses', entities.get('session'))
@@ -263,19 +276,70 @@ def build_bids_info(group, flist, root_path=None):
 		'session': ses,
 		'datatype': 'anat',
 		'input_acquisitions': ACQ_ORDER,
-		'source_images': relativize_paths(flist, root_path),
+		'source_images': relativize_paths(abs_flist, root_path),
 		'source_entities': relevant_entities,
 	}
 
-def discover_bids_inputs(search_path, extra_filters):
-	if BIDSLayout is None:
+def t2w_record_from_filename(filename, parse_file_entities):
+	entities = parse_file_entities(filename)
+	if entities.get('suffix') != 'T2w':
+		return None
+	if str(entities.get('acquisition', '')) not in ACQ_ORDER:
+		return None
+	if entities.get('subject') is None:
+		return None
+	entities = dict(entities)
+	entities['datatype'] = infer_datatype_from_path(filename)
+	return {'path': filename, 'entities': entities}
+
+def entity_matches(key, entity_value, wanted):
+	if entity_value is None:
+		return False
+	if key in INT_ENTITIES and str(entity_value).isdigit() and str(wanted).isdigit():
+		return int(entity_value) == int(wanted)
+	return str(entity_value) == str(wanted)
+
+def entities_match_filters(entities, filters):
+	for key, value in filters.items():
+		values = value if isinstance(value, list) else [value]
+		if not any(entity_matches(key, entities.get(key), v) for v in values):
+			return False
+	return True
+
+def glob_bids_records(search_path, filters, parse_file_entities):
+	# Only the selected subject (and session) folders are listed, not the whole dataset.
+	subjects = filters['subject'] if isinstance(filters['subject'], list) else [filters['subject']]
+	sessions = filters.get('session')
+	if sessions is not None and not isinstance(sessions, list):
+		sessions = [sessions]
+	roots = []
+	for sub in subjects:
+		sub_path = os.path.join(search_path, normalize_bids_entity('sub', sub))
+		if sessions is None:
+			roots.append(sub_path)
+		else:
+			roots += [os.path.join(sub_path, normalize_bids_entity('ses', ses)) for ses in sessions]
+
+	file_records = []
+	for root in roots:
+		for filename in sorted(pathlib.Path(root).glob('**/*_T2w.nii*')):
+			record = t2w_record_from_filename(str(filename), parse_file_entities)
+			if record is None:
+				continue
+			if entities_match_filters(record['entities'], filters):
+				file_records.append(record)
+	return file_records
+
+def discover_bids_inputs(search_path, extra_filters, database_path=None, reset=False):
+	try:
+		from bids import BIDSLayout
+		from bids.layout import BIDSLayoutIndexer, parse_file_entities
+	except ImportError:
 		raise ImportError('pybids is required for automatic BIDS discovery. Install "pybids".')
 
-	layout = BIDSLayout(search_path, validate=False)
 	filters = {
 		'suffix': 'T2w',
 		'extension': ['.nii', '.nii.gz'],
-		'scope': 'raw',
 	}
 	if 'acquisition' not in extra_filters:
 		filters['acquisition'] = ACQ_ORDER
@@ -283,13 +347,21 @@ def discover_bids_inputs(search_path, extra_filters):
 		filters['datatype'] = 'anat'
 	filters.update(extra_filters)
 
-	bids_files = layout.get(return_type='object', **filters)
-	file_records = []
-	for bids_file in bids_files:
-		entities = bids_file.get_entities()
-		if entities.get('subject') is None:
-			continue
-		file_records.append({'path': bids_file.path, 'entities': entities})
+	if 'subject' in filters:
+		file_records = glob_bids_records(search_path, filters, parse_file_entities)
+	else:
+		# Only filename entities are used, so sidecar metadata is not indexed.
+		# With database_path the index is stored there and reused by later runs.
+		indexer = BIDSLayoutIndexer(validate=False, index_metadata=False)
+		layout = BIDSLayout(search_path, validate=False, indexer=indexer,
+				database_path=database_path, reset_database=reset)
+		bids_files = layout.get(return_type='object', scope='raw', **filters)
+		file_records = []
+		for bids_file in bids_files:
+			entities = bids_file.get_entities()
+			if entities.get('subject') is None:
+				continue
+			file_records.append({'path': bids_file.path, 'entities': entities})
 
 	groups = collect_candidate_groups(file_records)
 	selected_group = choose_complete_group(groups)
@@ -298,21 +370,16 @@ def discover_bids_inputs(search_path, extra_filters):
 	return flist, bids_info
 
 def select_bids_inputs_from_filenames(filenames):
-	if parse_file_entities is None:
+	try:
+		from bids.layout import parse_file_entities
+	except ImportError:
 		raise ImportError('pybids is required for BIDS entity parsing. Install "pybids".')
 
 	file_records = []
 	for filename in filenames:
-		entities = parse_file_entities(filename)
-		if entities.get('suffix') != 'T2w':
-			continue
-		if str(entities.get('acquisition', '')) not in ACQ_ORDER:
-			continue
-		if entities.get('subject') is None:
-			continue
-		entities = dict(entities)
-		entities['datatype'] = infer_datatype_from_path(filename)
-		file_records.append({'path': filename, 'entities': entities})
+		record = t2w_record_from_filename(filename, parse_file_entities)
+		if record is not None:
+			file_records.append(record)
 
 	if len(file_records) == 0:
 		return filenames, None
@@ -323,274 +390,297 @@ def select_bids_inputs_from_filenames(filenames):
 	selected_group = choose_complete_group(groups)
 	flist = [selected_group['acq_map'][acq] for acq in ACQ_ORDER]
 
-	common_root = os.path.commonpath([os.path.abspath(path) for path in flist])
-	bids_info = build_bids_info(selected_group, flist, root_path=common_root)
+	abs_flist = [os.path.abspath(path) for path in flist]
+	common_root = os.path.commonpath(abs_flist)
+	bids_info = build_bids_info(selected_group, flist, root_path=common_root, abs_flist=abs_flist)
 	return flist, bids_info
 
-parser = argparse.ArgumentParser()
-parser.add_argument('-V', '--version', action='version',
-		version='%s version : v %s %s' % (app_name, version, release_date),
-		help='show version')
-
-parser.add_argument('-f', '--filenames', nargs='+',
-        help='filenames of input the low-res images; (full path required)\
-                e.g., -f a.nii.gz b.nii.gz c.nii.gz')
-parser.add_argument('-s', '--size', nargs='+', type=int,
-		help='size of the high-res reconstruction, optional; \
-				even positive integers required if set; \
-                e.g., -s 312 384 330')
-parser.add_argument('-r', '--resample', action='store_true',
-		help='resample the first low-res image in the high-res lattice \
-				and then exit. Usually used for determining a user \
-				defined size of the high-res reconstruction')
-parser.add_argument('-p', '--path', default='/opt/GGR-recon/data/')
-parser.add_argument('-t', '--temp_path', '-w', '--working_path',
-		default='/opt/GGR-recon/temp/',
-		help='path for intermediate files; default is /opt/GGR-recon/temp/')
-parser.add_argument('-o', '--out_path', default='/opt/GGR-recon/recons/')
-parser.add_argument('--bids-filter', action='append', default=[],
-		help='additional pybids filters for automatic discovery, as KEY=VALUE (repeatable)')
-args = parser.parse_args()
-flist = args.filenames
-sz = args.size
-resample_only = args.resample
-
-path = ensure_dir(args.path)
-working_path = ensure_dir(args.temp_path)
-out_path = ensure_dir(args.out_path)
-
-bids_filters = {}
-try:
-	bids_filters = parse_bids_filters(args.bids_filter)
-except ValueError as exc:
-	print('Error:', str(exc))
-	sys.exit(1)
-
-bids_info = None
-if flist is None or len(flist) == 0:
+def main(argv=None):
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-V', '--version', action='version',
+			version='%s version : v %s %s' % (app_name, version, release_date),
+			help='show version')
+
+	parser.add_argument('-f', '--filenames', nargs='+',
+			help='filenames of input the low-res images; (full path required)\
+					e.g., -f a.nii.gz b.nii.gz c.nii.gz')
+	parser.add_argument('-s', '--size', nargs='+', type=int,
+			help='size of the high-res reconstruction, optional; \
+					even positive integers required if set; \
+					e.g., -s 312 384 330')
+	parser.add_argument('-r', '--resample', action='store_true',
+			help='resample the first low-res image in the high-res lattice \
+					and then exit. Usually used for determining a user \
+					defined size of the high-res reconstruction')
+	parser.add_argument('-p', '--path', default='/opt/GGR-recon/data/')
+	parser.add_argument('-t', '--temp_path', '-w', '--working_path',
+			default='/opt/GGR-recon/temp/',
+			help='path for intermediate files; default is /opt/GGR-recon/temp/')
+	parser.add_argument('-o', '--out_path', default='/opt/GGR-recon/recons/')
+	parser.add_argument('--bids-filter', action='append', default=[],
+			help='additional pybids filters for automatic discovery, as KEY=VALUE (repeatable)')
+	parser.add_argument('--bids-db',
+			help='directory to store the pybids index in and reuse on later runs; \
+					optional, the dataset is re-indexed every run if not set')
+	parser.add_argument('--reset-bids-db', action='store_true',
+			help='rebuild the index in --bids-db, e.g. after files were added')
+	args = parser.parse_args(argv)
+
+	import numpy as np
+	import SimpleITK as sitk
+	import scipy.fft
+	from scipy import signal
+	from rich.console import Console
+	from rich import box
+	from rich.table import Table
+	from rich.progress import Progress, TextColumn, BarColumn, TimeElapsedColumn
+	from utils import imread, imwrite, np_to_img, resample_iso_img, \
+			resample_iso_img_with_size, resample_img_like, save_filter, save_geo, \
+			print_header, RainbowHighlighter
+
+	flist = args.filenames
+	sz = args.size
+	resample_only = args.resample
+
+	path = ensure_dir(args.path)
+	working_path = ensure_dir(args.temp_path)
+	out_path = ensure_dir(args.out_path)
+
+	bids_filters = {}
 	try:
-		flist, bids_info = discover_bids_inputs(path, bids_filters)
-	except (ImportError, ValueError) as exc:
-		print('Error:', str(exc))
-		sys.exit(1)
-	if flist is None:
-		print('No BIDS image data found at:', path)
-		print('Expected at least one complete acq-{sag,cor,ax}_T2w set per subject[/session]')
-		print('Use --bids-filter to disambiguate if multiple sets exist')
-		sys.exit(1)
-else:
-	try:
-		flist, bids_info = select_bids_inputs_from_filenames(flist)
-	except (ImportError, ValueError) as exc:
-		print('Error:', str(exc))
-		sys.exit(1)
-
-n_imgs = len(flist)
-if n_imgs == 0:
-	print('No image data found!')
-	sys.exit(1)
-
-if sz != None and (len(sz) != 3 or np.any(np.array(sz) <= 0)):
-	print('SIZE =', sz)
-	print('Error: SIZE should comprise 3 positive integers')
-	sys.exit(1)
-
-print('path : ' + str(path))
-print('temp_path : ' + str(working_path))
-print('out_path : ' + str(out_path))
-
-os.makedirs(out_path, exist_ok=True)
-os.makedirs(working_path, exist_ok=True)
-
-bids_output_file = os.path.join(working_path, 'bids_output_name.json')
-if bids_info is not None:
-	with open(bids_output_file, 'w') as f:
-		json.dump(bids_info, f, indent=2)
-else:
-	if os.path.isfile(bids_output_file):
-		os.remove(bids_output_file)
-
-img_path = []
-img_fn = []
-img_ext = []
-
-
-for filename in flist:
-    fpname =  pathlib.PurePosixPath(filename)
-    base, first_dot, rest = fpname.name.partition('.')
-    #filename = filename.with_name(base)
-    p = str(fpname.parent)
-    if not p.endswith('/'):
-        p += '/'
-    img_path.append( p )
-    img_fn.append( str(base) )
-    img_ext.append( '.'+str(rest) )
-
-console = Console()
-print_header(console)
-
-# step 0: make the orientations the same for all LR images
-for ii in range(0, n_imgs):
-  inputVolume = img_path[ii] + img_fn[ii] + img_ext[ii]
-  outputVolume = working_path + img_fn[ii] + img_ext[ii]
-  print(str(inputVolume))
-  print(str(outputVolume))
-  reader = sitk.ImageFileReader()
-  reader.SetFileName( inputVolume )
-  inputImage = reader.Execute();
-  # Now we clone the input image.
-  reorientedImage = sitk.DICOMOrient( inputImage, 'LPS' )
-  writer = sitk.ImageFileWriter()
-  writer.SetFileName( outputVolume )
-  writer.Execute( reorientedImage )
-
-#print('completed step 0')
-#print('\t- make the orientations the same for all LR images')
-
-
-# step 1: resample the images
-img0 = imread(working_path + img_fn[0] + img_ext[0])
-if sz == None:
-	img0x = resample_iso_img(img0)
-	sz = img0x.GetSize()
-else:
-	img0x = resample_iso_img_with_size(img0, sz)
-
-sz = img0x.GetSize() # update the variable of image size
-
-# =========== Print summary of the execution =============
-mode = 'Preprocessing'
-if resample_only:
-	mode = 'Resampling'
-table = Table(title='Summary of %s/preprocess.py execution' % app_name,
-		box=box.HORIZONTALS,
-		show_header=True, header_style='bold magenta')
-table.add_column('Mode', justify='center')
-table.add_column('# images', justify='center')
-table.add_column('Images', justify='center')
-table.add_column('Image size', justify='center', no_wrap=True)
-table.add_column('Resolution', justify='center')
-table.add_row(mode, str(n_imgs),
-		str([s1+s2 for s1, s2 in zip(img_fn, img_ext)]),
-		str(sz), '%0.4f mm'%img0x.GetSpacing()[0])
-console.print(table, justify='center')
-console.print('\n')
-
-
-if resample_only:
-	imwrite(img0x, out_path + img_fn[0] + '_x' + img_ext[0])
-	rainbow = RainbowHighlighter()
-	console.print(rainbow('The first low-res image has been resampled in the high-res lattice'))
-	console.print('\n')
-	console.print('See it at: [green italic]%s' \
-			% out_path + img_fn[0] + '_x' + img_ext[0])
-	console.print('\n\n')
-	sys.exit(0)
-
-imwrite(img0x, working_path + img_fn[0] + '_x' + img_ext[0])
-
-origin = img0x.GetOrigin()
-spacing = img0x.GetSpacing()
-direction = img0x.GetDirection()
-
-lr_size = np.zeros([3, n_imgs])
-lr_spacing = np.zeros([3, n_imgs])
-lr_size[:,0] = np.array(img0.GetSize(), dtype=np.int64)
-lr_size[lr_size[:,0]%2!=0,0] -= 1
-lr_spacing[:,0] = np.array(img0.GetSpacing())
-for ii in track(range(1, n_imgs), '[yellow]Resampling images...'):
-	img = imread(working_path + img_fn[ii] + img_ext[ii])
-	lr_spacing[:,ii] = np.array(img.GetSpacing())
-	lr_size[:,ii] = np.array(img.GetSize())
-
-	lr_size[:,ii] = np.minimum(lr_size[:,ii],
-			np.around(spacing / lr_spacing[:,ii] * sz)).astype(np.int64)
-	lr_size[lr_size[:,ii]%2!=0,ii] -= 1
-
-	I = resample_img_like(img, img0x)
-	imwrite(I, working_path + img_fn[ii] + '_x' + img_ext[ii])
-
-savemat(working_path + 'geo_property.mat', {'sz': sz, 'origin': origin, \
-		'spacing': spacing, 'direction': direction})
-
-prefix = [''] + ['reg_'] * (n_imgs - 1)
-sufix = ['_x'] * n_imgs
-txt = [''.join(s) for s in zip(*[prefix, img_fn, sufix, img_ext])]
-with open(working_path + 'data_fn.txt', 'w') as f:
-	for ii, fn in enumerate(txt):
-		f.write('%s,%s\n' % (fn, 'h_'+img_fn[ii]+'.mat'))
-
-#print('completed step 1')
-#print('\t- resample the images')
-
-# step 2: align up all resampled images
-for ii in track(range(1, n_imgs), '[magenta]Aligning images...'):
-	cmd = 'crlRigidRegistration -t 2 %s%s_x%s %s%s_x%s \
-			%sreg_%s_x%s %stfm2_%s.tfm > /dev/null 2>&1' % \
-			(working_path, img_fn[0], img_ext[0], \
-			working_path, img_fn[ii], img_ext[ii], \
-			working_path, img_fn[ii], img_ext[ii], \
-			working_path, img_fn[ii])
-	os.system(cmd)
-#print('completed step 2')
-#print('\t- align up all resampled images')
-
-# step 3: create filters for deconvolution
-for ii in track(range(0, n_imgs), '[cyan]Creating filters...'):
-	fft_win = 1
-	max_factor = -np.inf
-	for jj in range(0, 3):
-		factor = lr_spacing[jj,ii] / spacing[jj]
-		if factor > 1:
-			# FWHM in the unit of number of pixel and convert it to sigma
-			sigma = factor / 2.355
-			filter_len = sz[jj] *2
-			gw = signal.windows.gaussian(filter_len, std=sigma)
-			gw /= np.sum(gw)
-			# put it onto 3D space
-			shape = np.ones(3, dtype=np.int64)
-			shape[jj] = filter_len
-			gw = np.reshape(gw, shape)
-			gw = np.roll(gw, -filter_len//2, axis=jj)
-			# move it to Fourier domain
-			GW = np.abs(fftn(gw, [sz[0]*2, sz[1]*2, sz[2]*2]))
-
-			w1_sz = np.array([sz[0]*2, sz[1]*2, sz[2]*2], dtype=np.int64)
-			w1_sz[jj] = lr_size[jj,ii]# // 2
-			w0_sz = np.array([sz[0]*2, sz[1]*2, sz[2]*2], dtype=np.int64)
-			w0_sz[jj] -= lr_size[jj,ii]*2
-			w = np.concatenate([np.ones(w1_sz), \
-					np.zeros(w0_sz), np.ones(w1_sz)], axis=jj)
-			#w = np.abs(fftn(ifftn(w), [sz[0]*2, sz[1]*2, sz[2]*2]))
-			#fft_win *= np.transpose(w * GW + 1j * w * GW, axes=[2,1,0])
-			if max_factor < factor:
-				#fft_win = np.transpose(w * GW + 1j * w * GW, axes=[2,1,0])
-				fft_win = np.transpose(GW, axes=[2,1,0])
-				max_factor = factor
+		bids_filters = parse_bids_filters(args.bids_filter)
+	except ValueError as exc:
+		print('Error:', str(exc), file=sys.stderr)
+		return 1
+
+	bids_info = None
+	if flist is None or len(flist) == 0:
+		try:
+			flist, bids_info = discover_bids_inputs(path, bids_filters,
+					database_path=args.bids_db, reset=args.reset_bids_db)
+		except (ImportError, ValueError) as exc:
+			print('Error:', str(exc), file=sys.stderr)
+			return 1
+		if flist is None:
+			print('No BIDS image data found at:', path, file=sys.stderr)
+			print('Expected at least one complete acq-{sag,cor,ax}_T2w set per subject[/session]', file=sys.stderr)
+			print('Use --bids-filter to disambiguate if multiple sets exist', file=sys.stderr)
+			return 1
+	else:
+		try:
+			flist, bids_info = select_bids_inputs_from_filenames(flist)
+		except (ImportError, ValueError) as exc:
+			print('Error:', str(exc), file=sys.stderr)
+			return 1
+
+	n_imgs = len(flist)
+	if n_imgs == 0:
+		print('No image data found!', file=sys.stderr)
+		return 1
+
+	if sz != None and (len(sz) != 3 or np.any(np.array(sz) <= 0)):
+		print('SIZE =', sz, file=sys.stderr)
+		print('Error: SIZE should comprise 3 positive integers', file=sys.stderr)
+		return 1
+
+	print('path : ' + str(path))
+	print('temp_path : ' + str(working_path))
+	print('out_path : ' + str(out_path))
+
+	os.makedirs(out_path, exist_ok=True)
+	os.makedirs(working_path, exist_ok=True)
+
+	bids_output_file = os.path.join(working_path, 'bids_output_name.json')
+	if bids_info is not None:
+		with open(bids_output_file, 'w') as f:
+			json.dump(bids_info, f, indent=2)
+	else:
+		if os.path.isfile(bids_output_file):
+			os.remove(bids_output_file)
+
+	entries = [make_img_entry(filename, working_path) for filename in flist]
 
-	savemat(working_path+'h_'+img_fn[ii]+'.mat', {'fft_win': fft_win})
+	console = Console()
+	print_header(console)
 
-#print('completed step 3')
-#print('\t- create filters for deconvolution')
+	# step 0: make the orientations the same for all LR images
+	# (kept in memory; only the resampled _x images are written for registration)
+	# ITK releases the GIL, so the per-image work in steps 0-1 runs on threads
+	def reorient(inputVolume):
+		return sitk.DICOMOrient(imread(inputVolume), 'LPS')
 
-# step 4: volume fusion
-z = sitk.GetArrayFromImage(img0x)
-L = np.ones_like(z)
-for ii in track(range(1, n_imgs), '[medium_purple]Fusing images...'):
-	img = imread(working_path + 'reg_' + img_fn[ii] + '_x' + img_ext[ii])
-	a = sitk.GetArrayFromImage(img)
-	z += a
-	L += (a != 0).astype(np.float32)
+	input_volumes = [entry.input for entry in entries]
+	for inputVolume in input_volumes:
+		print(str(inputVolume))
+	with ThreadPoolExecutor(max_workers=n_imgs) as executor:
+		oriented = list(executor.map(reorient, input_volumes))
 
-z[L!=0] = z[L!=0] / L[L!=0]
+	#print('completed step 0')
+	#print('\t- make the orientations the same for all LR images')
 
-img_z = np_to_img(z, img0x)
-imwrite(img_z, working_path + 'img_mean' + img_ext[0])
 
-#print('completd step 4')
-#print('\t- volume fusion')
+	# step 1: resample the images
+	img0 = oriented[0]
+	if sz == None:
+		img0x = resample_iso_img(img0)
+		sz = img0x.GetSize()
+	else:
+		img0x = resample_iso_img_with_size(img0, sz)
+
+	sz = img0x.GetSize() # update the variable of image size
+
+	# =========== Print summary of the execution =============
+	mode = 'Preprocessing'
+	if resample_only:
+		mode = 'Resampling'
+	table = Table(title='Summary of %s/preprocess.py execution' % app_name,
+			box=box.HORIZONTALS,
+			show_header=True, header_style='bold magenta')
+	table.add_column('Mode', justify='center')
+	table.add_column('# images', justify='center')
+	table.add_column('Images', justify='center')
+	table.add_column('Image size', justify='center', no_wrap=True)
+	table.add_column('Resolution', justify='center')
+	table.add_row(mode, str(n_imgs),
+			str([entry.fn + entry.ext for entry in entries]),
+			str(sz), '%0.4f mm'%img0x.GetSpacing()[0])
+	console.print(table, justify='center')
+	console.print('\n')
+
+
+	if resample_only:
+		imwrite(img0x, out_path + entries[0].fn + '_x' + entries[0].ext)
+		rainbow = RainbowHighlighter()
+		console.print(rainbow('The first low-res image has been resampled in the high-res lattice'))
+		console.print('\n')
+		console.print('See it at: [green italic]%s' \
+				% out_path + entries[0].fn + '_x' + entries[0].ext)
+		console.print('\n\n')
+		return 0
+
+	imwrite(img0x, entries[0].working_x)
+
+	origin = img0x.GetOrigin()
+	spacing = img0x.GetSpacing()
+	direction = img0x.GetDirection()
+
+	# one bar for steps 1-4: (n_imgs - 1) resamplings, registrations and fusions, n_imgs filters
+	progress = Progress(TextColumn("[progress.description]{task.description}"),
+			BarColumn(bar_width=None), TimeElapsedColumn(), console=console)
+	with progress:
+		task = progress.add_task('[yellow]Resampling images...', total=4 * n_imgs - 3)
+
+		lr_spacing = [np.array(img.GetSpacing()) for img in oriented]
+
+		def resample(ii):
+			I = resample_img_like(oriented[ii], img0x)
+			imwrite(I, entries[ii].working_x)
+
+		progress.update(task, description='[yellow]Resampling images...')
+		with ThreadPoolExecutor(max_workers=max(1, n_imgs - 1)) as executor:
+			for _ in executor.map(resample, range(1, n_imgs)):
+				progress.advance(task)
+
+		save_geo(working_path + 'geo_property.json', sz, origin, spacing, direction)
+
+		# recon.py reads the reference image as is and the others after registration
+		txt = [entries[0].working_x] + [entry.working_reg_x for entry in entries[1:]]
+		with open(working_path + 'data_fn.txt', 'w') as f:
+			f.write(''.join('%s,%s\n' % (os.path.basename(fn), os.path.basename(entry.filter))
+					for fn, entry in zip(txt, entries)))
+
+		#print('completed step 1')
+		#print('\t- resample the images')
+
+		# step 2: align up all resampled images
+		def register(ii):
+			cmd = ['crlRigidRegistration', '-t', '2',
+					entries[0].working_x, entries[ii].working_x,
+					entries[ii].working_reg_x, entries[ii].tfm]
+			return subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+		# registrations run as concurrent child processes, at most one per core
+		max_procs = max(1, min(n_imgs - 1, os.cpu_count() or 1))
+		queued = list(range(1, n_imgs))
+		procs = [register(ii) for ii in queued[:max_procs]]
+		queued = queued[max_procs:]
+		progress.update(task, description='[magenta]Aligning images...')
+		for _ in range(1, n_imgs):
+			procs.pop(0).wait()
+			progress.advance(task)
+			if len(queued) > 0:
+				procs.append(register(queued.pop(0)))
+		#print('completed step 2')
+		#print('\t- align up all resampled images')
+
+		# step 3: create filters for deconvolution
+		progress.update(task, description='[cyan]Creating filters...')
+		for ii in range(0, n_imgs):
+			# only the axis with the largest low-res/high-res spacing ratio is filtered
+			factors = lr_spacing[ii] / np.asarray(spacing)
+			jj = int(np.argmax(factors))
+			factor = factors[jj]
+			fft_win = 1
+			if factor > 1:
+				# FWHM in the unit of number of pixel and convert it to sigma
+				sigma = factor / 2.355
+				filter_len = sz[jj] *2
+				# single precision is enough for the Fourier-domain weights recon.py uses
+				gw = signal.windows.gaussian(filter_len, std=sigma).astype(np.float32)
+				gw /= np.sum(gw)
+				gw = np.roll(gw, -filter_len//2)
+				# move it to Fourier domain; the zero-padded 3D FFT of a 1D kernel is
+				# constant along the other axes, so only the 1D spectrum is kept and
+				# recon.py broadcasts it. gw is real: mirror the half spectrum.
+				GW = np.abs(scipy.fft.rfft(gw))
+				GW = np.concatenate([GW, GW[-2:0:-1]])
+				# put it onto 3D space
+				shape = np.ones(3, dtype=np.int64)
+				shape[jj] = filter_len
+				GW = np.reshape(GW, shape)
+				fft_win = np.transpose(GW, axes=[2,1,0])
+
+			save_filter(entries[ii].filter, fft_win)
+			progress.advance(task)
+
+		#print('completed step 3')
+		#print('\t- create filters for deconvolution')
+
+		# step 4: volume fusion
+		z = sitk.GetArrayFromImage(img0x).astype(np.float32, copy=False)
+		# L counts the images covering each voxel; it starts at 1 for img0x, so it is never 0
+		L = np.ones(z.shape, dtype=np.uint8)
+		nonzero = np.empty(z.shape, dtype=bool)
+		reg_fns = [entry.working_reg_x for entry in entries[1:]]
+		# read the next registered image in the background while the current one is added
+		with ThreadPoolExecutor(max_workers=1) as executor:
+			future = executor.submit(imread, reg_fns[0]) if len(reg_fns) > 0 else None
+			progress.update(task, description='[medium_purple]Fusing images...')
+			for ii in range(1, n_imgs):
+				img = future.result()
+				if ii < len(reg_fns):
+					future = executor.submit(imread, reg_fns[ii])
+				# zero-copy view; img stays referenced until the next iteration
+				a = sitk.GetArrayViewFromImage(img)
+				np.add(z, a, out=z)
+				np.not_equal(a, 0, out=nonzero)
+				L += nonzero
+				progress.advance(task)
+
+		np.divide(z, L, out=z)
+
+	img_z = np_to_img(z, img0x)
+	imwrite(img_z, working_path + 'img_mean' + entries[0].ext)
+
+	#print('completd step 4')
+	#print('\t- volume fusion')
+
+	# rainbow = RainbowHighlighter()
+	console.print('\n')
+	console.print('THE PRE-PROCESSING HAS BEEN COMPLETED.')
+	console.print('\n')
+	return 0
+
 
-# rainbow = RainbowHighlighter()
-console.print('\n')
-console.print('THE PRE-PROCESSING HAS BEEN COMPLETED.')
-console.print('\n')
+if __name__ == '__main__':
+	sys.exit(main())
@@ -1,3 +1,5 @@
+import json
+import os
 import numpy as np
 import SimpleITK as sitk
 from numpy.fft import fftn, ifftn
@@ -5,9 +7,7 @@ from random import randint
 from rich.panel import Panel
 from rich.highlighter import Highlighter
 
-app_name = 'GGR-recon'
-version = '0.9.3'
-release_date = '2024-10-14'
+from version import app_name, version, release_date
 
 def print_header(console):
 	console.print('\n\n')
@@ -27,6 +27,33 @@ def imread(fn):
 def imwrite(img, fn):
 	sitk.WriteImage(sitk.Cast(img, sitk.sitkFloat32), fn)
 
+def save_filter(fn, fft_win):
+	fft_win = np.asarray(fft_win)
+	out = np.lib.format.open_memmap(fn, mode='w+', dtype=fft_win.dtype, shape=fft_win.shape)
+	out[...] = fft_win
+	out.flush()
+
+def load_filter(fn):
+	# temp folders written by older versions still hold .mat filters
+	if fn.endswith('.mat'):
+		from scipy.io import loadmat
+		return loadmat(fn)['fft_win']
+	return np.load(fn, mmap_mode='r')
+
+def save_geo(fn, sz, origin, spacing, direction):
+	with open(fn, 'w') as f:
+		json.dump({'sz': [int(x) for x in sz], 'origin': list(origin),
+				'spacing': list(spacing), 'direction': list(direction)}, f)
+
+def load_geo(working_path):
+	fn = working_path + 'geo_property.json'
+	if os.path.isfile(fn):
+		with open(fn, 'r') as f:
+			return json.load(f)
+	from scipy.io import loadmat
+	geo = loadmat(working_path + 'geo_property.mat')
+	return {key: geo[key][0].tolist() for key in ['sz', 'origin', 'spacing', 'direction']}
+
 def np_to_img(x, ref):
 	img = sitk.GetImageFromArray(x)
 	img.SetOrigin(ref.GetOrigin())
@@ -50,7 +77,7 @@ def resample_iso_img(img):
 
 	sz = np.array(img.GetSize())
 	new_sz = np.floor(spacing / new_spacing * sz).astype(np.uint32)
-	new_sz[new_sz % 2 == 1] -= 1
+	new_sz -= new_sz & 1
 
 	return resample_img(img, new_spacing, new_sz.tolist())
 
@@ -59,7 +86,7 @@ def resample_iso_img_with_size(img, sz):
 	new_spacing = np.array([min(spacing)] * 3)
 
 	new_sz = np.array(sz)
-	new_sz[new_sz % 2 == 1] -= 1
+	new_sz -= new_sz & 1
 
 	return resample_img(img, new_spacing, new_sz.tolist())
 
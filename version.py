@@ -0,0 +1,3 @@
+app_name = 'GGR-recon'
+version = '0.9.3'
+release_date = '2024-10-14'